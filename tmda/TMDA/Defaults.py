@@ -170,6 +170,64 @@ if not 'DELIVERY' in vars():
         raise ConfigError( \
               "non-qmail users must define DELIVERY in " + TMDARC)
 
+# MAILDIR_NFS_SAFE
+# Set this variable to True if your Maildirs live on NFS.  Messages
+# are then moved from tmp/ to new/ with link() followed by unlink(),
+# as the Maildir specification originally required, instead of a
+# single rename().
+#
+# Default is False (turned off)
+if not 'MAILDIR_NFS_SAFE' in vars():
+    MAILDIR_NFS_SAFE = False
+
+# MAILDIR_ENABLE_ALARM
+# Set this variable to True to guard each Maildir delivery with a
+# 24-hour SIGALRM, in case writing to the Maildir hangs (e.g, on a
+# stuck NFS mount).  The alarm handler is installed when TMDA starts.
+#
+# Default is False (turned off)
+if not 'MAILDIR_ENABLE_ALARM' in vars():
+    MAILDIR_ENABLE_ALARM = False
+
+# MAILDIR_SYNC_MODE
+# A string specifying how a message delivered to a Maildir is made
+# durable.  Possible values include:
+#
+# "full"
+#    Sync the message file to disk before moving it into new/.  This
+#    is what the Maildir specification asks for.
+#
+# "group"
+#    As "full", but the sync is done by a background thread which
+#    handles the messages of several concurrent deliveries in one go.
+#    Only useful when one process delivers from several threads.
+#
+# "dirfsync"
+#    Don't sync the message file; sync the new/ directory once the
+#    message has been moved there instead.  This is much cheaper for
+#    large messages, but it does NOT make the message durable: only
+#    its directory entry is.  After a crash the file in new/ may be
+#    empty or truncated.  (ext4's auto_da_alloc doesn't help here, as
+#    it only applies to renames which replace an existing file.)
+#
+# "none"
+#    Don't sync anything; leave it to the operating system.
+#
+# Default is "full".
+if not 'MAILDIR_SYNC_MODE' in vars():
+    MAILDIR_SYNC_MODE = 'full'
+
+# PRESERVE_ATIME
+# Set this variable to True to restore the access time of mbox and
+# mmdf files after delivering to them, so that mail readers which
+# compare it with the modification time can tell there is new mail.
+# This costs an extra system call or two per delivery, and is of
+# little use on filesystems mounted noatime or relatime.
+#
+# Default is False (turned off)
+if not 'PRESERVE_ATIME' in vars():
+    PRESERVE_ATIME = False
+
 # RECIPIENT_DELIMITER
 # A single character which specifies the separator between user names
 # and address extensions (e.g, user-ext).
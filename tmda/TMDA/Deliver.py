@@ -23,11 +23,15 @@
 
 
 import fcntl
+import itertools
+import mmap
 import os
+import queue
+import re
 import signal
 import socket
-import stat
 import sys
+import threading
 import time
 
 from . import Defaults
@@ -35,15 +39,75 @@ from . import Errors
 from . import Util
 
 
+# Buffer size used when writing messages to mailboxes; mail messages
+# are commonly far larger than the io module's default.
+DELIVERY_BUFSIZE = 1 << 18
+
+# Host name used in Maildir file names, with invalid characters
+# escaped.  It won't change for the life of the process.
+_HOSTNAME = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+
+# Process ID and number of Maildir deliveries made by this process,
+# used in Maildir file names.
+_PID = os.getpid()
+_deliveries = itertools.count(1)
+
+
+def _reset_pid():
+    """Pick up the new process ID in a forked child."""
+    global _PID
+    _PID = os.getpid()
+
+os.register_at_fork(after_in_child=_reset_pid)
+
+
+# Subdirectories every Maildir must have.
+_MAILDIR_SUBDIRS = frozenset(('tmp', 'cur', 'new'))
+
+# Classify a delivery instruction by its first character; see
+# Deliver._get_instructions().
+_INSTRUCTION_RE = re.compile(r"""
+    (?P<program>\|)            # |program
+  | (?P<forward>&|[^\W_])      # &address, or an address itself
+  | (?P<mmdf>:)               # :mmdf
+  | (?P<file>[/~])            # mbox, or maildir if it ends in a /
+""", re.VERBOSE)
+
+# Internal delivery instruction meaning 'filter to stdout'.
+_FILTER_OPTION = '_filter_'
+
+# Headers to remove from every delivered message.
+_PURGED = Defaults.PURGED_HEADERS_DELIVERY
+
+
 def alarm_handler(signum, frame):
     """Handle an alarm."""
     print('Signal handler called with signal', signum)
     raise IOError("Couldn't open device!")
 
+if Defaults.MAILDIR_ENABLE_ALARM:
+    # Maildir deliveries are guarded by an alarm; install the handler
+    # once rather than for every delivery.
+    signal.signal(signal.SIGALRM, alarm_handler)
 
-def lock_file(fp):
-    """Do fcntl file locking."""
-    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+
+def lock_file(fp, deadline=30):
+    """Do fcntl file locking.
+
+    Rather than blocking indefinitely, poll for the lock with
+    exponential backoff for up to deadline seconds, then give up by
+    raising BlockingIOError."""
+    end = time.monotonic() + deadline
+    delay = 0.001
+    while True:
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() > end:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
 
 
 def unlock_file(fp):
@@ -51,16 +115,224 @@ def unlock_file(fp):
     fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
 
 
+def _trailer(message):
+    """Return the newlines to write after message: one to complete
+    its last line if necessary, plus a trailing blank line."""
+    if message.endswith(b'\n'):
+        return b'\n'
+    return b'\n\n'
+
+
+def _writev(fd, buffers):
+    """Write all of the byte strings in buffers to fd, gathering them
+    with writev() so they are neither copied nor written piecewise."""
+    buffers = [memoryview(b) for b in buffers if b]
+    while buffers:
+        written = os.writev(fd, buffers)
+        # Drop whatever was written in case of a short write.
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+        if written:
+            buffers[0] = buffers[0][written:]
+
+
+def _entry_size(message):
+    """Return the number of bytes message takes up in an mbox,
+    including its trailer."""
+    return len(message) + len(_trailer(message))
+
+
+class MboxAppender:
+    """Append messages to an mbox file by copying them into a memory
+    mapping of space reserved past the end of the file.
+
+    fp is the mbox file, already open for reading and writing and
+    locked.  size is the total _entry_size() of the messages that will
+    be appended; exactly that much is reserved, with one fallocate and
+    one mmap, so once every message has been appended the file holds
+    nothing else.  Until then the rest of the reserved space reads as
+    NUL bytes, so call abort() if the batch can't be completed.
+    """
+    def __init__(self, fp, size):
+        self.fd = fp.fileno()
+        self.orig_length = self.length = os.fstat(self.fd).st_size
+        self.end = self.orig_length + size
+        self.map = None
+        self.map_offset = 0
+        if not size:
+            return
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                # Allocating the blocks up front means running out of
+                # disk space is reported here, rather than as a SIGBUS
+                # while writing into the mapping.  A failed fallocate
+                # may still have grown the file, so it's undone below
+                # too.
+                os.posix_fallocate(self.fd, self.orig_length, size)
+            else:
+                os.ftruncate(self.fd, self.end)
+            # mmap offsets must be a multiple of the allocation
+            # granularity.
+            self.map_offset = self.length - (self.length %
+                                             mmap.ALLOCATIONGRANULARITY)
+            self.map = mmap.mmap(self.fd, self.end - self.map_offset,
+                                 offset=self.map_offset)
+        except BaseException:
+            os.ftruncate(self.fd, self.orig_length)
+            raise
+
+    def _unmap(self):
+        # Unmapping hands the written pages to the page cache; the
+        # caller's sync writes them out, so no msync() here.
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def append(self, message):
+        """Append message, with a trailing newline if its last line is
+        incomplete and a trailing blank line."""
+        trailer = _trailer(message)
+        size = len(message) + len(trailer)
+        if self.length + size > self.end:
+            raise ValueError('message does not fit in the reserved space')
+        start = self.length - self.map_offset
+        middle = start + len(message)
+        self.map[start:middle] = message
+        self.map[middle:middle + len(trailer)] = trailer
+        self.length += size
+
+    def close(self):
+        """Release the mapping once every message has been appended.
+        The caller is responsible for syncing the file."""
+        self._unmap()
+
+    def abort(self):
+        """Truncate the file back to its original length."""
+        self._unmap()
+        os.ftruncate(self.fd, self.orig_length)
+
+
+def _sync_fd(fd):
+    """Force the data of the file open on fd to disk.  Use fdatasync()
+    where available since we don't need the rest of the inode metadata
+    synced."""
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def sync_file(fp):
+    """Force the file's data to disk.  See _sync_fd()."""
+    _sync_fd(fp.fileno())
+
+
+class _SyncRequest:
+    """A file waiting to be synced by a _GroupSyncer."""
+    def __init__(self, fd):
+        self.fd = fd
+        self.error = None
+        self.done = threading.Event()
+
+
+class _GroupSyncer:
+    """Sync files from a background thread, a group at a time.
+
+    Deliveries running concurrently in several threads hand their
+    files to sync(), and the worker thread syncs whatever has queued
+    up (up to max_group files) before waking all of them, so their
+    journal commits can be shared.  The thread is only started when
+    first needed, and restarted if it has died.
+    """
+    max_group = 64
+    # How often (in seconds) a waiting sync() checks the worker is
+    # still alive.
+    poll_interval = 1
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def sync(self, fp):
+        """Force fp's data to disk, returning once the worker has done
+        so.  fp may be closed as soon as this returns."""
+        request = _SyncRequest(os.dup(fp.fileno()))
+        worker = self._worker()
+        self.queue.put(request)
+        # Don't wait forever if the worker dies without answering.
+        while not request.done.wait(self.poll_interval):
+            if not worker.is_alive() and not request.done.is_set():
+                raise OSError('group sync thread died')
+        if request.error is not None:
+            raise request.error
+
+    def _worker(self):
+        """Return the worker thread, starting one if necessary."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run,
+                                               name='TMDA group sync',
+                                               daemon=True)
+                self.thread.start()
+            return self.thread
+
+    def _forget_thread(self):
+        """The worker doesn't survive a fork, and the queue may be
+        locked or hold requests from threads that don't exist in the
+        child; start afresh there."""
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            group = [self.queue.get()]
+            while len(group) < self.max_group:
+                try:
+                    group.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for request in group:
+                    try:
+                        _sync_fd(request.fd)
+                    except Exception as e:
+                        request.error = e
+                    try:
+                        os.close(request.fd)
+                    except Exception as e:
+                        # Errors from close() can mean the data
+                        # didn't make it (e.g, on NFS).
+                        if request.error is None:
+                            request.error = e
+            finally:
+                # Whatever happens, don't leave anyone waiting.
+                for request in group:
+                    request.done.set()
+
+
+_group_syncer = _GroupSyncer()
+os.register_at_fork(after_in_child=_group_syncer._forget_thread)
+
+
 class Deliver:
-    def __init__(self, msg, delivery_option):
+    def __init__(self, msg, delivery_option, sync_mode=None):
         """
         msg is an email.message object.
 
         deliver_option is a delivery action option string returned
         from the TMDA.FilterParser instance.
+
+        sync_mode says how Maildir deliveries make the message
+        durable; see Defaults.MAILDIR_SYNC_MODE, which is used when
+        it isn't given.
         """
         self.msg = msg
         self.option = delivery_option
+        if sync_mode is None:
+            sync_mode = Defaults.MAILDIR_SYNC_MODE
+        self.sync_mode = sync_mode
         self.env_sender = os.environ.get('SENDER')
 
     def _get_instructions(self, option):
@@ -70,31 +342,30 @@ class Deliver:
 
         ('forward', 'me@new.job.com')
         """
-        first = option[0]
-        last = option[-1]
+        match = _INSTRUCTION_RE.match(option)
+        if match is None:
+            # internal setting meaning 'filter to stdout'
+            if option == _FILTER_OPTION:
+                return ('filter', 'stdout')
+            return None, None
+        kind = match.lastgroup
         # A program line begins with a vertical bar.
-        if first == '|':
+        if kind == 'program':
             return ('program', option[1:].strip())
         # A forward line begins with an ampersand.  If the address
         # begins with a letter or number, you may leave out the
         # ampersand.
-        if first == '&' or first.isalnum():
+        if kind == 'forward':
             return ('forward', option.strip('&').strip())
         # An mmdf line begins with a :
-        if first == ':':
+        if kind == 'mmdf':
             return ('mmdf', os.path.expanduser(option[1:].strip()))
         # An mbox line begins with a slash or tilde, and does not end
-        # with a slash.
-        if first in ('/', '~') and last != '/':
-            return ('mbox', os.path.expanduser(option))
-        # A maildir line begins with a slash or tilde and ends with a
-        # slash.
-        if first in ('/', '~') and last == '/':
+        # with a slash.  A maildir line begins with a slash or tilde
+        # and ends with a slash.
+        if option[-1] == '/':
             return ('maildir', os.path.expanduser(option))
-        # internal setting meaning 'filter to stdout'
-        if option == '_filter_':
-            return ('filter', 'stdout')
-        return None, None
+        return ('mbox', os.path.expanduser(option))
 
 
     def get_instructions(self):
@@ -107,11 +378,8 @@ class Deliver:
                   'Delivery instruction "%s" is not recognized!' % self.option)
         return (self.delivery_type, self.delivery_dest)
 
-    def deliver(self):
-        """Deliver the message appropriately."""
-        # Optionally, remove some headers.
-        Util.purge_headers(self.msg, Defaults.PURGED_HEADERS_DELIVERY)
-        (boxtype, dest) = self.get_instructions()
+    def __check_destination(self, boxtype, dest):
+        """Raise if dest is not a suitable destination for boxtype."""
         if boxtype in ( 'mmdf', 'mbox', 'maildir' ):
             # Ensure destination path exists.
             if not os.path.exists(dest):
@@ -123,6 +391,28 @@ class Deliver:
                 raise Errors.DeliveryError( \
                       'Destination "%s" is a symlink!' % dest)
 
+    def __flatten(self, msg, boxtype):
+        """Return msg in the form expected by the boxtype delivery
+        method."""
+        # Optionally, remove some headers.
+        if _PURGED:
+            Util.purge_headers(msg, _PURGED)
+
+        escape_from = boxtype in ('mmdf', 'mbox')
+        add_from_ = boxtype in ('program', 'mmdf', 'mbox')
+
+        if boxtype in ( 'mmdf', 'mbox', 'maildir' ):
+            # Mailbox files are written in binary mode.
+            flatten = Util.msg_as_bytes
+        else:
+            flatten = Util.msg_as_string
+        return flatten(msg, mangle_from_=escape_from, unixfrom=add_from_)
+
+    def deliver(self):
+        """Deliver the message appropriately."""
+        (boxtype, dest) = self.get_instructions()
+        self.__check_destination(boxtype, dest)
+
         deliver = {'program': self.__deliver_program,
                    'forward': self.__deliver_forward,
                    'mmdf': self.__deliver_mmdf,
@@ -131,82 +421,112 @@ class Deliver:
                    'filter': sys.stdout.write
                    }[boxtype]
 
-        escape_from = boxtype in ('mmdf', 'mbox')
-        add_from_ = boxtype in ('program', 'mmdf', 'mbox')
+        deliver(self.__flatten(self.msg, boxtype), dest)
 
-        msg = Util.msg_as_string(self.msg,
-                             mangle_from_=escape_from,
-                             unixfrom=add_from_)
-        deliver(msg, dest)
+    def deliver_batch(self, messages):
+        """Deliver several messages to the mbox given by the delivery
+        option, opening and locking the file only once for the whole
+        batch.
 
+        messages is a sequence of email.message objects.
 
-    def __deliver_program(self, message, program):
-        """Deliver message to /bin/sh -c program."""
-        Util.runcmd_checked(program, message)
-
-    def __deliver_forward(self, message, address):
-        """Forward message to address, preserving the existing Return-Path."""
-        Util.sendmail(message, address, self.env_sender)
-
-    def __deliver_mmdf(self, message, mmdf):
-        """Reliably deliver a mail message into an mmdf file.
-
-        Basicly a copy of __deliver_mbox():
-        Just make sure each message is surrounded by "\1\1\1\1\n"
+        The messages are copied into the file through an MboxAppender
+        and the file is synced once after the last one.
         """
+        (boxtype, mbox) = self.get_instructions()
+        if boxtype != 'mbox':
+            raise Errors.DeliveryError( \
+                  'Batch delivery is only supported for mbox files, not "%s"' \
+                  % self.option)
+        self.__check_destination(boxtype, mbox)
+        # Flatten everything before touching the file, so a bad
+        # message can't leave a partial batch behind.
+        messages = [self.__flatten(msg, boxtype) for msg in messages]
         try:
-            # When orig_length is None, we haven't opened the file yet.
-            orig_length = None
-            # Open the mmdf file.
-            fp = open(mmdf, 'rb+')
+            # When appender is None, we haven't started appending yet.
+            appender = None
+            # Open the mbox file.
+            fd = os.open(mbox, os.O_RDWR)
+            fp = os.fdopen(fd, 'rb+', buffering=0)
             lock_file(fp)
-            status_old = os.fstat(fp.fileno())
-            # Check if it _is_ an mmdf file; mmdf files must start
-            # with "\1\1\1\1\n" in their first line, or are 0-length files.
-            fp.seek(0, 0)                # seek to start
-            first_line = fp.readline()
-            if first_line != '' and first_line[:5] != '\1\1\1\1\n':
-                # Not an mmdf file; abort here.
+            preserve_atime = Defaults.PRESERVE_ATIME
+            if preserve_atime:
+                status_old = os.fstat(fp.fileno())
+            # Check if it _is_ an mbox file; mbox files must start
+            # with "From " in their first line, or are 0-length files.
+            head = os.pread(fp.fileno(), 5, 0)
+            if head != b'' and head != b'From ':
+                # Not an mbox file; abort here.
                 unlock_file(fp)
                 fp.close()
                 raise Errors.DeliveryError( \
-                      'Destination "%s" is not an mmdf file!' % mmdf)
-            fp.seek(0, 2)                # seek to end
-            orig_length = fp.tell()      # save original length
-            fp.write('\1\1\1\1\n')
-            # Add a trailing newline if last line incomplete.
-            if message[-1] != '\n':
-                message = message + '\n'
-            # Write the message.
-            fp.write(message)
-            # Add a trailing blank line.
-            fp.write('\n')
-            fp.write('\1\1\1\1\n')
-            fp.flush()
-            os.fsync(fp.fileno())
+                      'Destination "%s" is not an mbox file!' % mbox)
+            appender = MboxAppender(fp, sum(_entry_size(message)
+                                            for message in messages))
+            for message in messages:
+                appender.append(message)
+            appender.close()
+            sync_file(fp)
+            if preserve_atime:
+                status_new = os.fstat(fp.fileno())
             # Unlock and close the file.
-            status_new = os.fstat(fp.fileno())
             unlock_file(fp)
             fp.close()
-            # Reset atime.
-            os.utime(mmdf, (status_old[stat.ST_ATIME], status_new[stat.ST_MTIME]))
-        except IOError as txt:
+            if preserve_atime:
+                # Reset atime.
+                os.utime(mbox, ns=(status_old.st_atime_ns,
+                                   status_new.st_mtime_ns))
+        except BaseException as txt:
+            # Clean up whatever went wrong, so the reserved space isn't
+            # left in the mbox as NUL bytes.
             try:
-                if not fp.closed and not orig_length is None:
-                    # If the file was opened and we know how long it was,
-                    # try to truncate it back to that length.
-                    fp.truncate(orig_length)
+                if not fp.closed and appender is not None:
+                    # If we started appending, truncate the file back
+                    # to its original length.
+                    appender.abort()
                 unlock_file(fp)
                 fp.close()
             except:
                 pass
+            if not isinstance(txt, IOError):
+                raise
             raise Errors.DeliveryError( \
-                  'Failure writing message to mmdf file "%s" (%s)' % (mmdf, txt))
+                  'Failure writing message to mbox file "%s" (%s)' % (mbox, txt))
+
+
+    def __deliver_program(self, message, program):
+        """Deliver message to /bin/sh -c program."""
+        Util.runcmd_checked(program, message)
+
+    def __deliver_forward(self, message, address):
+        """Forward message to address, preserving the existing Return-Path."""
+        Util.sendmail(message, address, self.env_sender)
+
+    def __deliver_mmdf(self, message, mmdf):
+        """Reliably deliver a mail message into an mmdf file.
+
+        Just like an mbox, except that each message is surrounded by
+        "\1\1\1\1\n".
+        """
+        self.__deliver_mbox_family(message, mmdf, 'mmdf',
+                                   b'\1\1\1\1\n', True)
 
     def __deliver_mbox(self, message, mbox):
         """Reliably deliver a mail message into an mboxrd-format mbox file.
 
         See <URL:http://www.qmail.org/man/man5/mbox.html>
+        """
+        # The "From " line is already part of the message.
+        self.__deliver_mbox_family(message, mbox, 'mbox', b'From ', False)
+
+    def __deliver_mbox_family(self, message, dest, boxtype, magic_prefix,
+                              wrap_with_prefix):
+        """Reliably append a mail message to the mailbox file dest.
+
+        boxtype names the file format in error messages.  The file
+        must be empty or start with magic_prefix.  If wrap_with_prefix
+        is true, magic_prefix is also written before and after the
+        message.
 
         Based on code from getmail
         <URL:http://pyropus.ca/software/getmail/>
@@ -216,37 +536,41 @@ class Deliver:
         try:
             # When orig_length is None, we haven't opened the file yet.
             orig_length = None
-            # Open the mbox file.
-            fp = open(mbox, 'rb+')
+            # Open the file.  It's unbuffered: the entry is written
+            # straight from memory with one writev().
+            fd = os.open(dest, os.O_RDWR | os.O_APPEND)
+            fp = os.fdopen(fd, 'rb+', buffering=0)
             lock_file(fp)
-            status_old = os.fstat(fp.fileno())
-            # Check if it _is_ an mbox file; mbox files must start
-            # with "From " in their first line, or are 0-length files.
-            fp.seek(0, 0)                # seek to start
-            first_line = fp.readline()
-            if first_line != '' and first_line[:5] != 'From ':
-                # Not an mbox file; abort here.
+            preserve_atime = Defaults.PRESERVE_ATIME
+            if preserve_atime:
+                status_old = os.fstat(fp.fileno())
+            # Check that it's the right kind of file; it must start
+            # with magic_prefix, or be 0-length.
+            head = os.pread(fp.fileno(), len(magic_prefix), 0)
+            if head != b'' and head != magic_prefix:
+                # Wrong kind of file; abort here.
                 unlock_file(fp)
                 fp.close()
                 raise Errors.DeliveryError( \
-                      'Destination "%s" is not an mbox file!' % mbox)
+                      'Destination "%s" is not an %s file!' % (dest, boxtype))
             fp.seek(0, 2)                # seek to end
             orig_length = fp.tell()      # save original length
-            # Add a trailing newline if last line incomplete.
-            if message[-1] != '\n':
-                message = message + '\n'
-            # Write the message.
-            fp.write(message)
-            # Add a trailing blank line.
-            fp.write('\n')
-            fp.flush()
-            os.fsync(fp.fileno())
+            # Add a trailing newline if last line incomplete, and a
+            # trailing blank line.
+            buffers = [message, _trailer(message)]
+            if wrap_with_prefix:
+                buffers = [magic_prefix] + buffers + [magic_prefix]
+            _writev(fp.fileno(), buffers)
+            sync_file(fp)
+            if preserve_atime:
+                status_new = os.fstat(fp.fileno())
             # Unlock and close the file.
-            status_new = os.fstat(fp.fileno())
             unlock_file(fp)
             fp.close()
-            # Reset atime.
-            os.utime(mbox, (status_old[stat.ST_ATIME], status_new[stat.ST_MTIME]))
+            if preserve_atime:
+                # Reset atime.
+                os.utime(dest, ns=(status_old.st_atime_ns,
+                                   status_new.st_mtime_ns))
         except IOError as txt:
             try:
                 if not fp.closed and not orig_length is None:
@@ -258,7 +582,8 @@ class Deliver:
             except:
                 pass
             raise Errors.DeliveryError( \
-                  'Failure writing message to mbox file "%s" (%s)' % (mbox, txt))
+                  'Failure writing message to %s file "%s" (%s)' \
+                  % (boxtype, dest, txt))
 
     def __deliver_maildir(self, message, maildir):
         """Reliably deliver a mail message into a Maildir.
@@ -272,7 +597,7 @@ class Deliver:
         General Public License version 2.
         """
         # (same as Postfix)
-        # 1. Create    tmp/time.P<pid>.hostname
+        # 1. Create    tmp/time.P<pid>Q<count>.hostname
         # 2. Rename to new/time.V<device>I<inode>.hostname
         #
         # When creating a file in tmp/ we use the process-ID because
@@ -288,44 +613,57 @@ class Deliver:
         # available through NFS, but this shouldn't be the case if the
         # NFS implementation is POSIX compliant.
 
-        # Set a 24-hour alarm for this delivery.
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(24 * 60 * 60)
+        sync_mode = self.sync_mode
+        if sync_mode not in ('full', 'group', 'dirfsync', 'none'):
+            raise Errors.ConfigError( \
+                "Unknown MAILDIR_SYNC_MODE: " + '"%s"' % sync_mode)
+
+        use_alarm = Defaults.MAILDIR_ENABLE_ALARM
+        if use_alarm:
+            # Set a 24-hour alarm for this delivery.
+            signal.alarm(24 * 60 * 60)
 
         dir_tmp = os.path.join(maildir, 'tmp')
-        dir_cur = os.path.join(maildir, 'cur')
         dir_new = os.path.join(maildir, 'new')
-        if not (os.path.isdir(dir_tmp) and
-                os.path.isdir(dir_cur) and
-                os.path.isdir(dir_new)):
+        # A single directory read tells us whether tmp, cur and new
+        # are all there.
+        try:
+            with os.scandir(maildir) as it:
+                subdirs = set(e.name for e in it if e.is_dir())
+        except OSError:
+            subdirs = set()
+        if not _MAILDIR_SUBDIRS <= subdirs:
             raise Errors.DeliveryError( 'not a Maildir! (%s)' % maildir)
 
-        now = time.time()
-        pid = os.getpid()
+        now = time.time_ns() // 1000000000
+        pid = _PID
 
-        hostname = socket.gethostname()
-        # To deal with invalid host names.
-        hostname = hostname.replace('/', '\\057').replace(':', '\\072')
+        hostname = _HOSTNAME
 
-        # e.g, 1043715037.P28810.hrothgar.la.mastaler.com
-        filename_tmp = '%lu.P%d.%s' % (now, pid, hostname)
+        # The delivery count keeps the name unique when several threads
+        # of this process deliver within the same second.
+        # e.g, 1043715037.P28810Q1.hrothgar.la.mastaler.com
+        filename_tmp = '%lu.P%dQ%d.%s' % (now, pid, next(_deliveries),
+                                          hostname)
         fname_tmp = os.path.join(dir_tmp, filename_tmp)
-        # File must not already exist.
-        if os.path.exists(fname_tmp):
-            raise Errors.DeliveryError( fname_tmp + 'already exists!')
 
         # Get user & group of maildir.
         s_maildir = os.stat(maildir)
-        maildir_owner = s_maildir[stat.ST_UID]
-        maildir_group = s_maildir[stat.ST_GID]
+        maildir_owner = s_maildir.st_uid
+        maildir_group = s_maildir.st_gid
 
-        # Open file to write.
+        # Open file to write.  File must not already exist; O_EXCL
+        # makes the check atomic and the file is created mode 600.
         try:
-            with open(fname_tmp, 'w', encoding='utf-8') as f:
+            fd = os.open(fname_tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, 'wb', buffering=DELIVERY_BUFSIZE) as f:
                 f.write(message)
                 f.flush()
-                os.fsync(f.fileno())
-            os.chmod(fname_tmp, 0o600)
+                if sync_mode == 'full':
+                    sync_file(f)
+                elif sync_mode == 'group':
+                    _group_syncer.sync(f)
             try:
                 # If root, change the message to be owned by the
                 # Maildir owner
@@ -333,33 +671,60 @@ class Deliver:
             except OSError:
                 # Not running as root, can't chown file.
                 pass
+        except FileExistsError:
+            if use_alarm:
+                signal.alarm(0)
+            raise Errors.DeliveryError( fname_tmp + 'already exists!')
         except (OSError, IOError) as o:
-            signal.alarm(0)
+            if use_alarm:
+                signal.alarm(0)
             raise Errors.DeliveryError( \
                   'Failure writing file %s (%s)' % (fname_tmp, o))
 
         fstatus = os.stat(fname_tmp)
         # e.g, 1043715037.V20d04I18bfb.hrothgar.la.mastaler.com
-        filename_new = '%lu.V%lxI%lx.%s' % (now, fstatus[stat.ST_DEV],
-                                            fstatus[stat.ST_INO], hostname)
+        filename_new = '%lu.V%lxI%lx.%s' % (now, fstatus.st_dev,
+                                            fstatus.st_ino, hostname)
         fname_new = os.path.join(dir_new, filename_new)
-        # File must not already exist.
-        if os.path.exists(fname_new):
-            raise Errors.DeliveryError( fname_new + 'already exists!')
 
-        # Move message file from Maildir/tmp to Maildir/new
+        # Move message file from Maildir/tmp to Maildir/new.  Both
+        # are in the same Maildir, so rename() is atomic unless we're
+        # on NFS.  The device and inode numbers in the new name keep
+        # it unique; link() additionally refuses to replace an
+        # existing file.
         try:
-            os.link(fname_tmp, fname_new)
-            os.unlink(fname_tmp)
-        except OSError:
-            signal.alarm(0)
+            if Defaults.MAILDIR_NFS_SAFE:
+                os.link(fname_tmp, fname_new)
+                os.unlink(fname_tmp)
+            else:
+                os.rename(fname_tmp, fname_new)
+        except OSError as o:
+            if use_alarm:
+                signal.alarm(0)
             try:
                 os.unlink(fname_tmp)
             except:
                 pass
+            if isinstance(o, FileExistsError):
+                raise Errors.DeliveryError( fname_new + 'already exists!')
             raise Errors.DeliveryError( 'failure renaming "%s" to "%s"' \
                    % (fname_tmp, fname_new))
 
-        # Delivery is done, cancel the alarm.
-        signal.alarm(0)
-        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        if sync_mode == 'dirfsync':
+            # Make the new directory entry durable; the message data
+            # itself isn't synced.  See MAILDIR_SYNC_MODE.
+            try:
+                dirfd = os.open(dir_new, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    _sync_fd(dirfd)
+                finally:
+                    os.close(dirfd)
+            except OSError as o:
+                if use_alarm:
+                    signal.alarm(0)
+                raise Errors.DeliveryError( \
+                      'Failure syncing directory %s (%s)' % (dir_new, o))
+
+        if use_alarm:
+            # Delivery is done, cancel the alarm.
+            signal.alarm(0)
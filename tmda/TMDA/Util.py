@@ -551,6 +551,20 @@ def msg_as_string(msg, maxheaderlen=False, mangle_from_=False, unixfrom=False):
     return fp.getvalue()
 
 
+def msg_as_bytes(msg, maxheaderlen=False, mangle_from_=False, unixfrom=False):
+    """As msg_as_string(), but return the message as bytes, the way
+    it should be written to a binary file.  Non-ASCII data from the
+    original message is preserved as is rather than being decoded
+    and re-encoded."""
+    from email import generator
+    from io import BytesIO
+    fp = BytesIO()
+    g = generator.BytesGenerator(fp, mangle_from_=mangle_from_,
+                                 maxheaderlen=maxheaderlen)
+    g.flatten(msg, unixfrom=unixfrom)
+    return fp.getvalue()
+
+
 def sendmail(msgstr, envrecip, envsender):
     """Send e-mail via direct SMTP, or by opening a pipe to the
     sendmail program.
@@ -0,0 +1,371 @@
+import unittest
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+from email.parser import BytesParser
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import Deliver
+from TMDA import Errors
+
+test_message = b'\n'.join([
+    b'Return-Path: <sender@remote.com>',
+    b'From: sender@remote.com',
+    b'To: testuser@nowhere.com',
+    b'Subject: Delivery test',
+    b'',
+    b'This is a test message.',
+    b'From here on it is mangled.',
+    b'',
+])
+
+def parse(data=test_message):
+    msg = BytesParser().parsebytes(data)
+    # A fixed envelope header keeps the output independent of the clock.
+    msg.set_unixfrom('From sender@remote.com Thu Jan  1 00:00:00 2009')
+    return msg
+
+class InstructionTest(unittest.TestCase):
+    instructions = [
+        ('|/usr/bin/procmail ~/.procmailrc', ('program',
+                                            '/usr/bin/procmail ~/.procmailrc')),
+        ('&me@new.job.com', ('forward', 'me@new.job.com')),
+        ('me@new.job.com', ('forward', 'me@new.job.com')),
+        (':/var/spool/mail/me', ('mmdf', '/var/spool/mail/me')),
+        ('/var/mail/me', ('mbox', '/var/mail/me')),
+        ('/home/me/Maildir/', ('maildir', '/home/me/Maildir/')),
+        ('_filter_', ('filter', 'stdout')),
+        ('_unknown_', (None, None)),
+        ('', (None, None)),
+    ]
+
+    def testInstructions(self):
+        for (option, expected) in self.instructions:
+            d = Deliver.Deliver(None, option)
+            self.assertEqual(d._get_instructions(option), expected)
+
+    def testUnknownInstruction(self):
+        d = Deliver.Deliver(None, '?bogus')
+        self.assertRaises(Errors.DeliveryError, d.get_instructions)
+
+class WritevTest(unittest.TestCase):
+    def testShortWrites(self):
+        real_writev = os.writev
+        def short_writev(fd, buffers):
+            # Write at most 3 bytes at a time.
+            return real_writev(fd, [bytes(buffers[0][:3])])
+        (rfd, wfd) = os.pipe()
+        os.writev = short_writev
+        try:
+            Deliver._writev(wfd, [b'\1\1\1\1\n', b'', b'message', b'\n'])
+        finally:
+            os.writev = real_writev
+            os.close(wfd)
+        with os.fdopen(rfd, 'rb') as f:
+            self.assertEqual(f.read(), b'\1\1\1\1\nmessage\n')
+
+class GroupSyncerTest(unittest.TestCase):
+    def setUp(self):
+        self.fp = tempfile.TemporaryFile()
+
+    def tearDown(self):
+        self.fp.close()
+
+    def testSync(self):
+        syncer = Deliver._GroupSyncer()
+        syncer.sync(self.fp)
+        syncer.sync(self.fp)
+
+    def testCloseError(self):
+        syncer = Deliver._GroupSyncer()
+        real_close = os.close
+        failed = []
+        def failing_close(fd):
+            real_close(fd)
+            if threading.current_thread() is syncer.thread and not failed:
+                failed.append(fd)
+                raise OSError(errno.EIO, 'close failed')
+        os.close = failing_close
+        try:
+            self.assertRaises(OSError, syncer.sync, self.fp)
+            # The worker survived and keeps working.
+            syncer.sync(self.fp)
+        finally:
+            os.close = real_close
+        self.assertEqual(len(failed), 1)
+
+    def testDeadWorker(self):
+        class BrokenSyncer(Deliver._GroupSyncer):
+            poll_interval = 0.01
+            def _run(self):
+                pass
+        syncer = BrokenSyncer()
+        self.assertRaises(OSError, syncer.sync, self.fp)
+
+    def testForgetThread(self):
+        syncer = Deliver._GroupSyncer()
+        syncer.sync(self.fp)
+        old_queue = syncer.queue
+        syncer._forget_thread()
+        self.assertTrue(syncer.thread is None)
+        self.assertTrue(syncer.queue is not old_queue)
+
+class DeliverTestMixin(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def readFile(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+class MboxDeliverTest(DeliverTestMixin, unittest.TestCase):
+    def setUp(self):
+        DeliverTestMixin.setUp(self)
+        self.mbox = os.path.join(self.tmpdir, 'mbox')
+        open(self.mbox, 'wb').close()
+
+    def testDeliverEmpty(self):
+        Deliver.Deliver(parse(), self.mbox).deliver()
+        data = self.readFile(self.mbox)
+        self.assertTrue(data.startswith(b'From '))
+        self.assertTrue(data.endswith(b'This is a test message.\n'
+                                      b'>From here on it is mangled.\n\n'))
+
+    def testDeliverAppends(self):
+        Deliver.Deliver(parse(), self.mbox).deliver()
+        first = self.readFile(self.mbox)
+        Deliver.Deliver(parse(), self.mbox).deliver()
+        data = self.readFile(self.mbox)
+        self.assertEqual(len(data), 2 * len(first))
+        self.assertEqual(data.count(b'\nFrom '), 1)
+
+    def testPreserveAtime(self):
+        os.utime(self.mbox, (1000000000, 1000000000))
+        Defaults.PRESERVE_ATIME = True
+        try:
+            Deliver.Deliver(parse(), self.mbox).deliver()
+        finally:
+            Defaults.PRESERVE_ATIME = False
+        status = os.stat(self.mbox)
+        self.assertEqual(status.st_atime, 1000000000)
+        self.assertTrue(status.st_mtime > 1000000000)
+
+    def testDeliverIncompleteLastLine(self):
+        Deliver.Deliver(parse(test_message.rstrip(b'\n')), self.mbox).deliver()
+        self.assertTrue(self.readFile(self.mbox).endswith(b'mangled.\n\n'))
+
+    def testDeliverBatch(self):
+        Deliver.Deliver(parse(), self.mbox).deliver()
+        single = self.readFile(self.mbox)
+        Deliver.Deliver(None, self.mbox).deliver_batch([parse(), parse()])
+        self.assertEqual(self.readFile(self.mbox), single * 3)
+
+    def testDeliverBatchNotMbox(self):
+        maildir = os.path.join(self.tmpdir, 'Maildir') + os.sep
+        self.assertRaises(Errors.DeliveryError,
+                          Deliver.Deliver(None, maildir).deliver_batch,
+                          [parse()])
+
+    def testLocked(self):
+        with open(self.mbox, 'rb') as holder, open(self.mbox, 'rb') as f:
+            fcntl.flock(holder.fileno(), fcntl.LOCK_EX)
+            start = time.monotonic()
+            self.assertRaises(BlockingIOError, Deliver.lock_file, f, 0.2)
+            self.assertTrue(time.monotonic() - start >= 0.2)
+            # Once released, the lock is taken without waiting.
+            fcntl.flock(holder.fileno(), fcntl.LOCK_UN)
+            Deliver.lock_file(f, 0)
+
+    def testNotMbox(self):
+        with open(self.mbox, 'wb') as f:
+            f.write(b'garbage\n')
+        self.assertRaises(Errors.DeliveryError,
+                          Deliver.Deliver(parse(), self.mbox).deliver)
+        self.assertEqual(self.readFile(self.mbox), b'garbage\n')
+
+class MboxAppenderTest(DeliverTestMixin, unittest.TestCase):
+    def setUp(self):
+        DeliverTestMixin.setUp(self)
+        self.mbox = os.path.join(self.tmpdir, 'mbox')
+        with open(self.mbox, 'wb') as f:
+            f.write(b'From existing\n\n')
+
+    def testAppend(self):
+        # Messages crossing mmap page boundaries.
+        messages = [(b'From %d\n' % i) + b'x' * 3000 for i in range(5)]
+        size = sum(Deliver._entry_size(m) for m in messages)
+        with open(self.mbox, 'rb+', buffering=0) as f:
+            appender = Deliver.MboxAppender(f, size)
+            # Exactly the space needed is reserved.
+            self.assertEqual(os.fstat(f.fileno()).st_size,
+                             len(b'From existing\n\n') + size)
+            for message in messages:
+                appender.append(message)
+            appender.close()
+        expected = b'From existing\n\n' + b''.join(m + b'\n\n'
+                                                  for m in messages)
+        self.assertEqual(self.readFile(self.mbox), expected)
+
+    def testOverflow(self):
+        with open(self.mbox, 'rb+', buffering=0) as f:
+            appender = Deliver.MboxAppender(f, 10)
+            self.assertRaises(ValueError, appender.append, b'x' * 10)
+            appender.abort()
+
+    def testAbort(self):
+        message = b'From me\n\nbody\n'
+        with open(self.mbox, 'rb+', buffering=0) as f:
+            appender = Deliver.MboxAppender(f, Deliver._entry_size(message))
+            appender.append(message)
+            appender.abort()
+        self.assertEqual(self.readFile(self.mbox), b'From existing\n\n')
+
+    def testBatchFailure(self):
+        # An unexpected error partway through a batch leaves the mbox
+        # as it was, without any of the reserved space.
+        real_append = Deliver.MboxAppender.append
+        def failing_append(appender, message):
+            if appender.length > appender.orig_length:
+                raise RuntimeError('interrupted')
+            real_append(appender, message)
+        Deliver.MboxAppender.append = failing_append
+        try:
+            self.assertRaises(RuntimeError,
+                              Deliver.Deliver(None, self.mbox).deliver_batch,
+                              [parse(), parse()])
+        finally:
+            Deliver.MboxAppender.append = real_append
+        self.assertEqual(self.readFile(self.mbox), b'From existing\n\n')
+
+    def testFallocateFailure(self):
+        # Running out of space partway through the reservation leaves
+        # the mbox as it was, even if the file had already grown.
+        real_fallocate = os.posix_fallocate
+        def failing_fallocate(fd, offset, length):
+            real_fallocate(fd, offset, length // 2)
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        os.posix_fallocate = failing_fallocate
+        try:
+            self.assertRaises(Errors.DeliveryError,
+                              Deliver.Deliver(None, self.mbox).deliver_batch,
+                              [parse()])
+        finally:
+            os.posix_fallocate = real_fallocate
+        self.assertEqual(self.readFile(self.mbox), b'From existing\n\n')
+
+class MmdfDeliverTest(DeliverTestMixin, unittest.TestCase):
+    def setUp(self):
+        DeliverTestMixin.setUp(self)
+        self.mmdf = os.path.join(self.tmpdir, 'mmdf')
+        open(self.mmdf, 'wb').close()
+
+    def testDeliverTwice(self):
+        Deliver.Deliver(parse(), ':' + self.mmdf).deliver()
+        Deliver.Deliver(parse(), ':' + self.mmdf).deliver()
+        data = self.readFile(self.mmdf)
+        self.assertTrue(data.startswith(b'\1\1\1\1\nFrom '))
+        self.assertTrue(data.endswith(b'mangled.\n\n\1\1\1\1\n'))
+        self.assertEqual(data.count(b'\1\1\1\1\n'), 4)
+
+    def testNotMmdf(self):
+        with open(self.mmdf, 'wb') as f:
+            f.write(b'From sender@remote.com\n')
+        self.assertRaises(Errors.DeliveryError,
+                          Deliver.Deliver(parse(), ':' + self.mmdf).deliver)
+
+class MaildirDeliverTest(DeliverTestMixin, unittest.TestCase):
+    def setUp(self):
+        DeliverTestMixin.setUp(self)
+        self.maildir = os.path.join(self.tmpdir, 'Maildir') + os.sep
+        for sub in ('tmp', 'cur', 'new'):
+            os.makedirs(os.path.join(self.maildir, sub))
+
+    def testDeliver(self):
+        Deliver.Deliver(parse(), self.maildir).deliver()
+        self.assertEqual(os.listdir(os.path.join(self.maildir, 'tmp')), [])
+        new = os.listdir(os.path.join(self.maildir, 'new'))
+        self.assertEqual(len(new), 1)
+        path = os.path.join(self.maildir, 'new', new[0])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(self.readFile(path), test_message)
+
+    def testDeliver8bit(self):
+        message = test_message + b'Caf\xe9 au lait.\n'
+        Deliver.Deliver(parse(message), self.maildir).deliver()
+        new = os.listdir(os.path.join(self.maildir, 'new'))
+        path = os.path.join(self.maildir, 'new', new[0])
+        self.assertEqual(self.readFile(path), message)
+
+    def testDeliverNfsSafe(self):
+        Defaults.MAILDIR_NFS_SAFE = True
+        try:
+            self.testDeliver()
+        finally:
+            Defaults.MAILDIR_NFS_SAFE = False
+
+    def testDeliverGroupSync(self):
+        threads = [threading.Thread(target=Deliver.Deliver(
+                        parse(), self.maildir, sync_mode='group').deliver)
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        new = os.listdir(os.path.join(self.maildir, 'new'))
+        self.assertEqual(len(new), 8)
+        for name in new:
+            path = os.path.join(self.maildir, 'new', name)
+            self.assertEqual(self.readFile(path), test_message)
+
+    def testDeliverSyncModes(self):
+        for mode in ('full', 'dirfsync', 'none'):
+            Deliver.Deliver(parse(), self.maildir, sync_mode=mode).deliver()
+        new = os.listdir(os.path.join(self.maildir, 'new'))
+        self.assertEqual(len(new), 3)
+
+    def testDeliverDirfsync(self):
+        # Only the new/ directory is synced, not the message file.
+        real_sync_fd = Deliver._sync_fd
+        synced = []
+        def recording_sync_fd(fd):
+            synced.append(os.fstat(fd))
+            real_sync_fd(fd)
+        Deliver._sync_fd = recording_sync_fd
+        try:
+            Deliver.Deliver(parse(), self.maildir,
+                            sync_mode='dirfsync').deliver()
+        finally:
+            Deliver._sync_fd = real_sync_fd
+        new = os.stat(os.path.join(self.maildir, 'new'))
+        self.assertEqual([(st.st_dev, st.st_ino) for st in synced],
+                         [(new.st_dev, new.st_ino)])
+
+    def testBadSyncMode(self):
+        d = Deliver.Deliver(parse(), self.maildir, sync_mode='sometimes')
+        self.assertRaises(Errors.ConfigError, d.deliver)
+
+    def testPidAfterFork(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(int(Deliver._PID != os.getpid()))
+        (pid, status) = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(Deliver._PID, os.getpid())
+
+    def testNotMaildir(self):
+        os.rmdir(os.path.join(self.maildir, 'cur'))
+        self.assertRaises(Errors.DeliveryError,
+                          Deliver.Deliver(parse(), self.maildir).deliver)
+
+if __name__ == '__main__':
+    unittest.main()